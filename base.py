@@ -1,20 +1,22 @@
+import re
 import time
+import asyncio
 import logging
 import json
 import csv
-from datetime import timedelta
-from collections import defaultdict
-from urllib.parse import urljoin, urldefrag
-from tornado import httpclient, gen, queues
-from lxml import html
+from collections import defaultdict, OrderedDict
+from hashlib import blake2b
+from urllib.parse import urljoin, urlsplit
+from tornado import httpclient
+from lxml import etree
 
 
-class BQueue(queues.Queue):
+class BQueue(asyncio.Queue):
     """ Bureaucratic queue """
 
     def __init__(self, maxsize=0, capacity=0):
         """
-        :param maxsize: a default maxsize from tornado.queues.Queue,
+        :param maxsize: a default maxsize from asyncio.Queue,
             means maximum queue members at the same time.
         :param capacity: means a quantity of income tries before will refuse
             accepting incoming data
@@ -40,204 +42,306 @@ class BQueue(queues.Queue):
             if 0 < self.capacity == self.put_counter:
                 self.is_reached = True
 
+    def put_many(self, items):
+        """ Enqueue a batch in one call. The queues are unbounded, so no
+        awaiting per item is needed; stops early when capacity is reached.
+        :return: how many items were actually enqueued.
+        """
+        put = 0
+        for item in items:
+            if self.is_reached:
+                break
+            self.put_nowait(item)
+            put += 1
+        return put
+
+
+class URLSet:
+    """ Set that stores short url digests instead of the urls themselves.
+    A crawl records every url it ever sees, and an 8-byte digest is much
+    cheaper to keep around than a 200-byte url string. """
+
+    def __init__(self):
+        self._digests = set()
+
+    @staticmethod
+    def _digest(url):
+        return blake2b(url.encode(), digest_size=8).digest()
+
+    def add(self, url):
+        self._digests.add(self._digest(url))
+
+    def __contains__(self, url):
+        return self._digest(url) in self._digests
+
+    def __len__(self):
+        return len(self._digests)
+
+
+class LinkTarget:
+    """ Parser target which extracts, filters and classifies anchor hrefs
+    in the single pass the parser already makes over the page, so no
+    separate loop over the collected links is needed afterwards. """
+
+    def __init__(self, exclude_re, capture, base, base_prefix, allowed):
+        self.exclude_re = exclude_re
+        self.capture = capture
+        self.base = base
+        self.base_prefix = base_prefix
+        self.allowed = allowed
+        self.urls = []
+        self.urls_to_parse = []
+
+    def start(self, tag, attrib):
+        if tag != 'a' or 'href' not in attrib:
+            return
+        href = attrib['href']
+        if self.exclude_re and self.exclude_re.search(href):
+            return
+        href = href.partition('#')[0]
+        # fast paths for host-relative and absolute links; urljoin
+        # re-parses the base url on every call
+        if href.startswith('/') and not href.startswith('//'):
+            url = self.base_prefix + href
+        elif href.startswith(('http://', 'https://')):
+            url = href
+        else:
+            url = urljoin(self.base, href)
+        if url.startswith(self.allowed):
+            if self.capture in url:
+                self.urls_to_parse.append(url)
+            self.urls.append(url)
+
+    def close(self):
+        return self.urls, self.urls_to_parse
+
 
 class BaseWebSpider:
     OUTPUT_FORMATS = ['json', 'csv']
+    CACHE_SIZE = 256    # fetched pages kept for reuse between crawl and parse
 
     def __init__(self, base_url, capture_pattern, concurrency=2, timeout=300,
                  delay=0, headers=None, exclude=None, verbose=True,
-                 output='json', max_crawl=0, max_parse=0, start_url=None, retries=2):
+                 output='json', max_crawl=0, max_parse=0, start_url=None,
+                 max_clients=0, connect_timeout=None, request_timeout=None,
+                 allowed_prefixes=None, use_bloom=False):
 
         assert output in self.OUTPUT_FORMATS, 'Unsupported output format'
 
         self.output = output
+        # fixed at construction so every run of this spider targets a
+        # predictable file instead of minting a new name per call
+        name = base_url.split('//')[1].replace('www', '').replace('/', '')
+        self.output_file = '{}-{}.{}'.format(name, int(time.time()), output)
 
         self.base = base_url
+        base_parts = urlsplit(self.base)
+        self._base_prefix = '{}://{}'.format(base_parts.scheme,
+                                             base_parts.netloc)
         self.start_url = self.base if not start_url else start_url
+        # str.startswith takes a tuple, so one C call covers the whole
+        # whitelist (e.g. the base plus mobile/language subdomains)
+        self._allowed = tuple(allowed_prefixes) if allowed_prefixes \
+            else (self.base,)
         self.capture = capture_pattern
         self.exclude = exclude if isinstance(exclude, list) else []
+        # one compiled alternation beats a python loop over substrings
+        self._exclude_re = re.compile(
+            '|'.join(re.escape(e) for e in self.exclude)) \
+            if self.exclude else None
 
         self.concurrency = concurrency
-        self.timeout = timedelta(seconds=timeout) if timeout else None
+        self.timeout = timeout if timeout else None
         self.delay = delay
 
-        self.retries = retries    # retries for parser
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
 
         self.q_crawl = BQueue(capacity=max_crawl)
         self.q_parse = BQueue(capacity=max_parse)
 
-        self.brief = defaultdict(set)
-        self.data = []
+        self.brief = defaultdict(URLSet)
+        if use_bloom:
+            # imported here so pybloom_live stays an optional dependency;
+            # ~10 bits per url lets the 'seen' record scale to millions of
+            # urls at the price of rarely skipping one (1% false positives)
+            from pybloom_live import ScalableBloomFilter
+            self.brief['seen'] = ScalableBloomFilter(
+                initial_capacity=10000, error_rate=0.01)
+        self.parsed = 0
 
-        self.can_parse = False
+        self.cache = OrderedDict()
 
+        # WARNING instead of disabling outright, so library loggers are
+        # quieted too and real problems still surface
         self.log = logging.getLogger()
-        self.log.setLevel(logging.INFO)
-
-        if not verbose:
-            self.log.disabled = True
-
-        self.client = httpclient.AsyncHTTPClient(force_instance=True,
-                                                 defaults=headers)
-
-    def get_parsed_content(self, url):
+        self.log.setLevel(logging.INFO if verbose else logging.WARNING)
+
+        # the default SimpleAsyncHTTPClient opens a fresh connection per
+        # request; the curl client keeps connections to the host alive
+        httpclient.AsyncHTTPClient.configure(
+            'tornado.curl_httpclient.CurlAsyncHTTPClient')
+        # never let the client pool be smaller than the consumers it feeds
+        self.client = httpclient.AsyncHTTPClient(
+            force_instance=True, defaults=headers,
+            max_clients=max(max_clients, concurrency * 2))
+
+    def get_parsed_content(self, url, document):
         """
-        :param url: an url from which html will be parsed.
+        :param url: an url the document was fetched from.
+        :param document: the html fetched during crawling.
         :return: it has to return a dict with data.
-        Must be wrapped in a gen.coroutine.
+        Must be a coroutine (async def).
         """
         raise NotImplementedError
 
-    @gen.coroutine
     def get_urls(self, document):
-        urls = []
-        urls_to_parse = []
-        dom = html.fromstring(document)
-        for href in dom.xpath('//a/@href'):
-            if any(e in href for e in self.exclude):
-                    continue
-            url = urljoin(self.base, urldefrag(href)[0])
-            if url.startswith(self.base):
-                if self.capture in url:
-                    urls_to_parse.append(url)
-                urls.append(url)
-        return urls, urls_to_parse
-
-    @gen.coroutine
-    def get_html_from_url(self, url):
-
+        target = LinkTarget(self._exclude_re, self.capture, self.base,
+                            self._base_prefix, self._allowed)
+        parser = etree.HTMLParser(target=target)
+        parser.feed(document)
+        urls, urls_to_parse = parser.close()
+        # a page often repeats the same link many times (navs, footers)
+        return list(dict.fromkeys(urls)), list(dict.fromkeys(urls_to_parse))
+
+    async def get_html_from_url(self, url):
+
+        # Each url is fetched at most twice: once while crawling and once
+        # while parsing, so a cached entry can be dropped on its second use.
+        # The cache holds the fetch future rather than the finished body: a
+        # captured url enters both queues at once, and when crawler and
+        # parser pick it up concurrently the second caller must await the
+        # in-flight fetch instead of issuing its own.
+        future = self.cache.pop(url, None)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(url))
+            self.cache[url] = future
+            if len(self.cache) > self.CACHE_SIZE:
+                self.cache.popitem(last=False)
+        return await future
+
+    async def _fetch(self, url):
         try:
-            response = yield self.client.fetch(url)
-            doc = response.body if isinstance(response.body, str) \
-                else response.body.decode()
+            request = httpclient.HTTPRequest(
+                url, connect_timeout=self.connect_timeout,
+                request_timeout=self.request_timeout)
+            response = await self.client.fetch(request)
+            # lxml accepts bytes and picks the encoding from the document
+            # itself, so there is no point decoding the whole body here
+            return response.body
         except:
             self.log.error('Error during fetching urls!', exc_info=True)
-            return 
-        return doc
+            return
 
-    @gen.coroutine
-    def get_links_from_url(self, url):
-        document = yield self.get_html_from_url(url)
-        urls = yield self.get_urls(document)
-        return urls
+    async def get_links_from_url(self, url):
+        document = await self.get_html_from_url(url)
+        return self.get_urls(document)
 
-    @gen.coroutine
-    def __wait(self, name):
+    async def __wait(self, name):
         if self.delay > 0:
-            self.log.info('{} waits for {} sec.'.format(name, self.delay))
-            yield gen.sleep(self.delay)
+            self.log.info('%s waits for %s sec.', name, self.delay)
+            await asyncio.sleep(self.delay)
 
-    @gen.coroutine
-    def crawl_url(self):
-        current_url = yield self.q_crawl.get()
+    async def crawl_url(self):
+        log = self.log
+        current_url = await self.q_crawl.get()
         try:
-            if current_url in self.brief['crawling']:
-                self.log.info('Skipping the duplicate')
-                return    # go to finally block before return
-
-            self.log.info('Crawling: {}'.format(current_url))
+            log.info('Crawling: %s', current_url)
             self.brief['crawling'].add(current_url)
-            urls, urls_to_parse = yield self.get_links_from_url(current_url)
+            urls, urls_to_parse = await self.get_links_from_url(current_url)
             self.brief['crawled'].add(current_url)
 
-            for url in urls:
-                if self.q_crawl.is_reached:
-                    self.log.warning('I do not have to crawl anymore.')
-                    break
-                yield self.q_crawl.put(url)
-
-            for url in urls_to_parse:
-                if self.q_parse.is_reached:
-                    self.log.warning('I do not have to parse anymore')
-                    break
-
-                if url not in self.brief['parsing']:
-                    yield self.q_parse.put(url)
-                    self.brief['parsing'].add(url)
-                    self.log.info('Captured: {}'.format(url))
-
-            if not self.can_parse and self.q_parse.qsize() > 0:
-                self.can_parse = True
+            seen = self.brief['seen']
+            fresh = [url for url in urls if url not in seen]
+            queued = self.q_crawl.put_many(fresh)
+            for url in fresh[:queued]:
+                seen.add(url)
+            if queued < len(fresh):
+                log.warning('I do not have to crawl anymore.')
+
+            parsing = self.brief['parsing']
+            fresh = [url for url in urls_to_parse if url not in parsing]
+            queued = self.q_parse.put_many(fresh)
+            for url in fresh[:queued]:
+                parsing.add(url)
+                log.info('Captured: %s', url)
+            if queued < len(fresh):
+                log.warning('I do not have to parse anymore')
         finally:
             self.q_crawl.task_done()
 
-    @gen.coroutine
-    def parse_url(self):
-        url_to_parse = yield self.q_parse.get()
-        self.log.info('Parsing: {}'.format(url_to_parse))
+    async def parse_url(self):
+        url_to_parse = await self.q_parse.get()
+        self.log.info('Parsing: %s', url_to_parse)
         try:
-            content = yield self.get_parsed_content(url_to_parse)
-            self.data.append(content)
+            document = await self.get_html_from_url(url_to_parse)
+            content = await self.get_parsed_content(url_to_parse, document)
+            self._write_row(content)
         finally:
             self.q_parse.task_done()
 
-    @gen.coroutine
-    def crawler(self):
+    async def crawler(self):
         while True:
-            yield self.crawl_url()
-            yield self.__wait('Crawler')
-
-    @gen.coroutine
-    def parser(self):
-        retries = self.retries
+            await self.crawl_url()
+            await self.__wait('Crawler')
 
+    async def parser(self):
         while True:
-            if self.can_parse:
-                yield self.parse_url()
-            elif retries > 0:
-                retries -= 1
-                yield gen.sleep(0.5)
-            else:
-                break
-
-            yield self.__wait('Parser')
-        return
-
-    def _write_json(self, name):
+            await self.parse_url()
+            await self.__wait('Parser')
 
-        with open('{}-{}.json'.format(name, time.time()), 'w') as file:
-            json.dump(self.data, file)
+    def _open_output(self):
+        self._out = open(self.output_file, 'w')
+        self._writer = None    # csv writer, created on the first row
 
-    def _write_csv(self, name):
-        headers = self.data[0].keys()    # Make it better
-        with open('{}-{}.csv'.format(name, time.time()), 'w') as csvfile:
-            writer = csv.DictWriter(csvfile, headers)
-            writer.writeheader()
-            writer.writerows(self.data)
-
-    @gen.coroutine
-    def run(self):
+    def _write_row(self, row):
+        if self.output == 'json':
+            self._out.write(json.dumps(row) + '\n')
+        else:
+            if self._writer is None:
+                # headers come from the first row; rows with extra keys
+                # later on must not crash the writer
+                self._writer = csv.DictWriter(self._out, tuple(row.keys()),
+                                              extrasaction='ignore')
+                self._writer.writeheader()
+            self._writer.writerow(row)
+        self.parsed += 1
+
+    async def run(self):
         start = time.time()
 
         print('Start working')
 
-        self.q_crawl.put(self.start_url)
+        self._open_output()
+
+        self.brief['seen'].add(self.start_url)
+        self.q_crawl.put_nowait(self.start_url)
 
+        workers = []
         for _ in range(self.concurrency):
-            self.crawler()
-            self.parser()
+            workers.append(asyncio.ensure_future(self.crawler()))
+            workers.append(asyncio.ensure_future(self.parser()))
 
-        yield self.q_crawl.join(timeout=self.timeout)
-        yield self.q_parse.join()
+        await asyncio.wait_for(self.q_crawl.join(), self.timeout)
+        await self.q_parse.join()
+
+        # workers block on empty queues; both queues are drained here
+        for worker in workers:
+            worker.cancel()
 
         end = time.time()
         print('Parsing done in {} seconds'.format(end - start))
 
-        assert self.brief['crawling'] == self.brief['crawled'], \
+        assert len(self.brief['crawling']) == len(self.brief['crawled']), \
             'Crawling and crawled urls do not match'
 
-        assert len(self.brief['parsing']) == len(self.data), \
+        assert len(self.brief['parsing']) == self.parsed, \
             'PARSING != PARSED'
 
-        self.log.info('Total crawled: {}'.format(len(self.brief['crawled'])))
-        self.log.info('Total parsed: {}'.format(len(self.data)))
-        self.log.info('Starting write to file')
+        self.log.info('Total crawled: %s', len(self.brief['crawled']))
+        self.log.info('Total parsed: %s', self.parsed)
 
-        name = self.base.split('//')[1].replace('www', '').replace('/', '')
-        if self.output == 'json':
-            self._write_json(name)
-        elif self.output == 'csv':
-            self._write_csv(name)
+        self._out.close()
 
         print('Parsed data has been stored.')
         print('Task done!')
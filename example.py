@@ -1,20 +1,89 @@
-from tornado import gen, ioloop
-from bs4 import BeautifulSoup
+import asyncio
+from lxml import etree
 from base import BaseWebSpider
 
 
+class _StopParse(Exception):
+    """ Raised by parser targets to terminate parsing early. """
+
+
+class _TitleTarget:
+    """ Captures the <title> text and stops parsing at </head>,
+    so the page body is never fed through the parser. """
+
+    def __init__(self):
+        self.title = None
+        self._in_title = False
+
+    def start(self, tag, attrib):
+        if tag == 'title':
+            self._in_title = True
+            self.title = ''
+
+    def data(self, data):
+        if self._in_title:
+            self.title += data
+
+    def end(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        elif tag == 'head':
+            raise _StopParse
+
+    def close(self):
+        return self.title
+
+
+class _ElementTextTarget:
+    """ Captures the text content of the element with the given id and
+    stops parsing as soon as that element is closed. """
+
+    def __init__(self, element_id):
+        self.element_id = element_id
+        self.text = None
+        self._depth = 0
+
+    def start(self, tag, attrib):
+        if self._depth:
+            self._depth += 1
+        elif attrib.get('id') == self.element_id:
+            self._depth = 1
+            self.text = ''
+
+    def data(self, data):
+        if self._depth:
+            self.text += data
+
+    def end(self, tag):
+        if self._depth:
+            self._depth -= 1
+            if not self._depth:
+                raise _StopParse
+
+    def close(self):
+        return self.text
+
+
+def parse_with_target(document, target):
+    parser = etree.HTMLParser(target=target)
+    try:
+        parser.feed(document)
+        return parser.close()
+    except _StopParse:
+        return target.close()
+
+
 class MyWebSpider(BaseWebSpider):
 
-    @gen.coroutine
-    def get_parsed_content(self, url):
-        document = yield self.get_html_from_url(url)
-        bs = BeautifulSoup(document, 'lxml')
-        title = bs.find('title')
+    async def get_parsed_content(self, url, document):
+        title = parse_with_target(document, _TitleTarget())
         if title:
-            title = title.get_text().replace('- Wikipedia, the free encyclopedia', '')
-        lastmod = bs.find('', {'id': 'footer-info-lastmod'})
+            title = title.replace('- Wikipedia, the free encyclopedia', '')
+
+        lastmod = parse_with_target(
+            document, _ElementTextTarget('footer-info-lastmod'))
         if lastmod:
-            lastmod = lastmod.get_text().replace('This page was last modified on ', '')
+            lastmod = lastmod.replace('This page was last modified on ', '')
 
         return {'title': title, 'lastmod': lastmod}
 
@@ -36,5 +105,5 @@ if __name__ == '__main__':
                               headers=headers, exclude=exclude, output=output,
                               max_crawl=max_crawl, max_parse=max_parse)
 
-    io_loop = ioloop.IOLoop.current()
-    io_loop.run_sync(web_crawler.run)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(web_crawler.run())